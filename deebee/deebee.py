@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import logging
 import socket
 
@@ -5,11 +7,12 @@ from discord import DiscordException, Embed, Guild
 from redbot.core import checks, commands, Config
 from redbot.core.bot import Red
 from redbot.core.commands import Cog, Context
-from sqlalchemy.engine import ChunkedIteratorResult, ScalarResult
-from sqlalchemy.exc import ResourceClosedError
-from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from typing import List
+from typing import TYPE_CHECKING, List
+
+# SQLAlchemy is only imported once an engine is needed, keeping cog load cheap
+if TYPE_CHECKING:
+	from sqlalchemy.engine import ChunkedIteratorResult, ScalarResult
+	from sqlalchemy.orm import Session
 
 __version__ = "2.0.0"
 __author__ = ["atakiya"]
@@ -66,6 +69,8 @@ class DeeBee(Cog):
 		Recreate the pool (for when it dies)
 		"""
 		await self.recreate_engine(ctx.guild)
+		# Let dependent cogs replay anything they held back while the pool was dead
+		self.bot.dispatch("deebee_reconnect", ctx.guild)
 		await ctx.send(f"Database Connected")
 
 	@preferences.command()
@@ -192,6 +197,8 @@ class DeeBee(Cog):
 		return self.engine
 
 	async def create_engine(self, guild: Guild):
+		from sqlalchemy.ext.asyncio import create_async_engine
+
 		dialect = await self.config.guild(guild).db_dialect()
 		driver = await self.config.guild(guild).db_driver()
 		schema = await self.config.guild(guild).db_schema()
@@ -223,10 +230,16 @@ class DeeBee(Cog):
 		"""
 		return await self.query(ctx.guild, stmt, commit)
 
-	async def query(self, guild: Guild, stmt: str, commit: bool=False, single_result: bool=False) -> List[ScalarResult] or ScalarResult or None:
+	async def query(self, guild: Guild, stmt: str, commit: bool=False, single_result: bool=False, params: List[dict] or dict=None) -> List[ScalarResult] or ScalarResult or None:
 		"""
 		Use our active engine pool to query the database with the given statement, including parameters
+
+		Passing a list of dicts as `params` executes the statement once per entry, in a single batch
 		"""
+		from sqlalchemy.exc import ResourceClosedError
+		from sqlalchemy.ext.asyncio import AsyncSession
+		from sqlalchemy.orm import sessionmaker
+
 		if not self.engine:
 			await self.create_engine(guild)
 
@@ -240,7 +253,7 @@ class DeeBee(Cog):
 			log.debug(f"Executing query statment {stmt}")
 			async with async_session() as session:
 				session: Session
-				result: ChunkedIteratorResult = await session.execute(stmt)
+				result: ChunkedIteratorResult = await session.execute(stmt, params)
 				if commit:
 					await session.commit()
 				if result:
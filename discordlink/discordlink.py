@@ -1,21 +1,52 @@
+from __future__ import annotations
+
+import asyncio
 import io
 import logging
 
-from .models.DiscordLink import DiscordLink
+from .journal import LinkJournal
+from .loader import LinkLoader
 from datetime import datetime, timedelta, timezone
-from discord import DiscordException, Embed, Guild, Member, Message, Role
+from functools import lru_cache
+from discord import Colour, DiscordException, Embed, Guild, Member, Message, Role
 from redbot.core import checks, commands, Config
 from redbot.core.bot import Red
 from redbot.core.commands import Cog, Context
-from sqlalchemy import select, update
-from sqlalchemy.engine import Row
-from typing import List, MutableMapping
+from redbot.core.data_manager import cog_data_path
+from typing import TYPE_CHECKING, Awaitable, Dict, Iterable, List, MutableMapping, Optional
+
+# SQLAlchemy and the model are only imported on first use, keeping cog load cheap
+if TYPE_CHECKING:
+	from .models.DiscordLink import DiscordLink
+	from sqlalchemy.engine import Row
 
-__version__ = "1.0.1"
+__version__ = "1.1.0"
 __author__ = ["atakiya"]
 
 log = logging.getLogger("red.horizon.cogs.discordlink")
 
+@lru_cache(maxsize=None)
+def _orm():
+	"""
+	Returns the DiscordLink model and the sqlalchemy module, importing them on first use
+	"""
+	import sqlalchemy
+	from .models.DiscordLink import DiscordLink
+	return DiscordLink, sqlalchemy
+
+class RateLimitCounter(logging.Filter):
+	"""
+	Counts the rate limit warnings discord.py logs when it has to back off a request
+	"""
+	def __init__(self):
+		super().__init__()
+		self.hits = 0
+
+	def filter(self, record: logging.LogRecord) -> bool:
+		if "rate limit" in record.getMessage().lower():
+			self.hits += 1
+		return True
+
 class DiscordLinkCog(Cog):
 	def __init__(self, bot: Red):
 		self.bot = bot
@@ -24,12 +55,44 @@ class DiscordLinkCog(Cog):
 		default_guild = {
 			"verified_role": None,
 			"members_only": False,
+			"token_hash": False,
 		}
 		self.config.register_guild(**default_guild)
 
-		self.db = self.get_database()
-		# Used for tracking last sent bot message
-		self.last_message = None
+		# DeeBee is resolved lazily on first query, so load order doesn't matter
+		self._db_ready = asyncio.Event()
+		# State of in-flight verifications, keyed by invoking message id:
+		# their "Please wait" placeholder message, if any, and notes for the user to go with the final message
+		self.verify_states: Dict[int, dict] = {}
+		# How long verify's DB work may take before a placeholder is posted, in seconds
+		self.verify_placeholder_delay = 1.5
+		self.verify_stats = {
+			"verifications": 0,
+			"api_calls": 0,
+			# Cooldown and concurrency rejections, which never reach verify
+			"rejections": 0,
+			"rejection_api_calls": 0,
+		}
+		self.rate_limits = RateLimitCounter()
+		logging.getLogger("discord.http").addFilter(self.rate_limits)
+
+		# Non-critical writes (e.g. invalidations on member leave) go through here,
+		# so event handlers don't block on, or lose writes to, an unavailable database
+		self.journal = LinkJournal(
+			cog_data_path(self) / "journal.jsonl",
+			self.apply_journal_entries,
+			# Guilds aren't known before then, which apply_journal_entries needs to resolve the database
+			ready=self.bot.wait_until_red_ready
+		)
+		self.journal.start()
+
+		# Backing the bulk lookups other cogs use, see discord_links_for_discord_ids and discord_links_for_ckeys
+		self.links_by_discord_id = LinkLoader(self._fetch_links_for_discord_ids)
+		self.links_by_ckey = LinkLoader(self._fetch_links_for_ckeys)
+
+	def cog_unload(self):
+		self.journal.stop()
+		logging.getLogger("discord.http").removeFilter(self.rate_limits)
 
 	async def red_get_data_for_user(self, *, user_id: int) -> MutableMapping[str, io.BytesIO]:
 		return MutableMapping()
@@ -41,6 +104,67 @@ class DiscordLinkCog(Cog):
 		"""
 		pass
 
+	@discordlink.command()
+	@checks.admin_or_permissions(administrator=True)
+	async def stats(self, ctx: Context):
+		"""
+		Show Discord API usage of verifications since the cog was loaded
+		"""
+		verifications = self.verify_stats["verifications"]
+		api_calls = self.verify_stats["api_calls"]
+		embed = Embed(title="__Verification API usage:__")
+		embed.add_field(name="Verifications:", value=verifications, inline=False)
+		embed.add_field(name="API calls:", value=api_calls, inline=False)
+		embed.add_field(name="Calls per verification:", value=f"{api_calls / verifications:.2f}" if verifications else None, inline=False)
+		embed.add_field(name="Rejections (cooldown, concurrency):", value=self.verify_stats["rejections"], inline=False)
+		embed.add_field(name="API calls for rejections:", value=self.verify_stats["rejection_api_calls"], inline=False)
+		embed.add_field(name="Rate limit hits (bot wide):", value=self.rate_limits.hits, inline=False)
+		await ctx.send(embed=embed)
+
+	@commands.guild_only()
+	@discordlink.command()
+	@checks.is_owner()
+	async def backfilltokens(self, ctx: Context, batch_size: int = 1000):
+		"""
+		Fill `one_time_token_hash` for existing links that don't have it yet, in batches
+		"""
+		DiscordLink, sa = _orm()
+
+		db = await self.get_database()
+		table = DiscordLink.__table__
+		stmt = sa.update(
+			table
+		).where(
+			table.c.id == sa.bindparam("b_id")
+		).values(
+			one_time_token_hash = sa.bindparam("b_hash")
+		)
+
+		last_id = 0
+		filled = 0
+		async with ctx.typing():
+			while True:
+				links: List[DiscordLink] = await db.query(ctx.guild, sa.select(
+					DiscordLink
+				).where(
+					DiscordLink.id > last_id,
+					DiscordLink.one_time_token != None,
+					DiscordLink.one_time_token_hash == None
+				).order_by(
+					DiscordLink.id
+				).limit(batch_size))
+				if not links:
+					break
+
+				await db.query(ctx.guild, stmt, commit=True, params=[
+					{"b_id": link.id, "b_hash": DiscordLink.token_digest(link.one_time_token)} for link in links
+				])
+				last_id = links[-1].id
+				filled += len(links)
+				log.debug(f"backfilltokens: filled {filled} token digest(s) up to id {last_id}")
+
+		await ctx.send(f"Filled the token digest for {filled} link(s).")
+
 	@commands.guild_only()
 	@discordlink.group()
 	@checks.admin_or_permissions(administrator=True)
@@ -57,6 +181,52 @@ class DiscordLinkCog(Cog):
 		await self.config.guild(ctx.guild).members_only.set(new_setting)
 		await ctx.send(f"Guild Member restricted server entry is now {'enabled' if new_setting else 'disabled'}")
 
+	@preferences.command()
+	async def tokenhash(self, ctx: Context):
+		"""
+		Toggle whether or not to match OTP tokens by their digest in `one_time_token_hash`
+
+		The column has to be added first, e.g.
+		`ALTER TABLE discord_links ADD one_time_token_hash BINARY(32), ADD INDEX idx_discord_links_token_hash (one_time_token_hash, timestamp)`
+		and the gameserver has to fill it with the SHA-256 digest of new tokens, stripped of surrounding whitespace and lowercased.
+		Use `[p]discordlink backfilltokens` to fill it for existing tokens.
+		Enabling is refused while the column is missing, or unfilled for tokens that are still valid.
+		"""
+		current_setting = await self.config.guild(ctx.guild).token_hash()
+		new_setting = not current_setting
+
+		if new_setting:
+			DiscordLink, sa = _orm()
+			db = await self.get_database()
+			missing = sa.select(
+				sa.func.count()
+			).select_from(
+				DiscordLink
+			).where(
+				DiscordLink.one_time_token != None,
+				DiscordLink.one_time_token_hash == None
+			)
+			try:
+				missing_total: int = await db.query_single(ctx.guild, missing)
+				missing_valid: int = await db.query_single(ctx.guild, missing.where(
+					DiscordLink.timestamp >= datetime.now(timezone.utc) - timedelta(hours=4)
+				))
+			except sa.exc.SQLAlchemyError:
+				log.exception("Failed to check one_time_token_hash")
+				return await ctx.send("Could not check `one_time_token_hash`, make sure the column exists. OTP token digest lookups stay disabled.")
+
+			if missing_valid:
+				return await ctx.send(
+					f"{missing_valid} unexpired token(s) have no digest yet, so their users couldn't verify. "
+					f"Make sure the gameserver fills `one_time_token_hash` and run `{ctx.clean_prefix}discordlink backfilltokens`. "
+					"OTP token digest lookups stay disabled."
+				)
+			if missing_total:
+				await ctx.send(f"Warning: {missing_total} expired token(s) have no digest, run `{ctx.clean_prefix}discordlink backfilltokens` to fill them.")
+
+		await self.config.guild(ctx.guild).token_hash.set(new_setting)
+		await ctx.send(f"OTP token digest lookups are now {'enabled' if new_setting else 'disabled'}")
+
 	@preferences.command()
 	async def verifiedrole(self, ctx: Context, new_role_id: int = None):
 		"""
@@ -97,106 +267,175 @@ class DiscordLinkCog(Cog):
 		"""
 
 		verified_role: int = await self.config.guild(ctx.guild).verified_role()
+		self.verify_stats["verifications"] += 1
+		# Anything worth telling the user besides the result, merged into the final message
+		notes: List[str] = []
 
 		# First let's try to delete the message, as the OTP is still to be handled like a secret.
 		try:
-			await ctx.message.delete()
+			await self.api_call(ctx.message.delete())
 		except (DiscordException):
-			await ctx.send("I can't delete messages in this channel.\nPlease delete the message with your OTP token yourself.")
+			notes.append("I can't delete messages in this channel.\nPlease delete the message with your OTP token yourself.")
+		# From here on the error handler knows the message was dealt with, and what to tell the user about it
+		state = self.verify_states[ctx.message.id] = {
+			"placeholder": None,
+			"notes": notes,
+		}
 
 		# Check if user already has the role, if so, don't bother doing anything.
-		if verified_role in ctx.author.roles:
-			return await ctx.send("You are already verified.\nIf this is an error, please contact staff")
-
-		embed = Embed(
-			title="Please wait...",
-			description="Attempting to verify your account..."
-		)
-		message: Message = await ctx.send(embed=embed)
-		self.last_message = message
-
-		# Start showing a typing indicator
-		async with ctx.typing():
-			discord_link = await self.discord_link_for_discord_id(ctx.guild, ctx.author.id)
-
-			# Check if they might already be verified.
-			if discord_link and discord_link.valid:
-				# They are already verified, so let's just add any missing role(s).
-				if verified_role:
-					try:
-						await ctx.author.add_roles(ctx.guild.get_role(verified_role), reason=f"Reverified by Discord Link (ckey: `{discord_link.ckey}`)")
-					except (DiscordException):
-						# Uh oh, we couldn't add the role.
-						log.exception(f"Failed to add role {verified_role} to {ctx.author.id}, {DiscordException}")
-						await ctx.send("I can't add the missing role(s) to you. Please contact staff.")
-
-				# Let them know of course
-				embed.title = "Success!"
-				embed.description = "You are already verified. If you were missing any roles, they have been added."
-				embed.color = 0x00FF00
-				return await message.edit(embed=embed)
-
-			# No OTP and no valid Discordlink. This won't do.
-			if one_time_password is None:
-				embed.title = "Could not verify!"
-				embed.description = f"""No OTP token given.
-										Please log into the server and get your OTP token.
-										Usage: {ctx.prefix}verify super-cool-token"""
-				embed.set_footer(text="Error: No token passed.")
-				embed.color = 0xFF0000
-				return await message.edit(embed=embed)
-
-			# They have supplied an OTP token, let's see if its valid
-			discord_link = await self.discord_link_for_token(ctx, one_time_password)
-			# It is not valid, or it doesn't exist.
-			if not discord_link:
-				embed.title = "Could not verify!"
-				embed.description = """
-					Invalid OTP token.
-					Please make sure you generated a token by joining the server first.
-					Else make sure you copied the token correctly. Do not add anything after the token.
-					The token should have the format of words between dashes.
-					e.g. `super-cool-token`"""
-				embed.set_footer(text="Error: Invalid or expired OTP token.")
-				embed.color = 0xFF0000
-				return await message.edit(embed=embed)
-
-			# It does exist and matched. Let's continue.
-			# Update their db entry with their discordid.
-			await self.update_discord_link(ctx, one_time_password, ctx.author.id)
-
-			# Give them roles too, if any.
+		if any(role.id == verified_role for role in ctx.author.roles):
+			embed = Embed(
+				title="Already verified.",
+				description="You are already verified.\nIf this is an error, please contact staff",
+				color=0x00FF00
+			)
+			return await self.send_verify_status(ctx, embed)
+
+		# Only post a placeholder if the DB is slow, most verifications finish well before that.
+		work = asyncio.ensure_future(self.verify_link(ctx, one_time_password, verified_role, notes))
+		try:
+			try:
+				embed = await asyncio.wait_for(asyncio.shield(work), self.verify_placeholder_delay)
+			except asyncio.TimeoutError:
+				embed = Embed(
+					title="Please wait...",
+					description="Attempting to verify your account..."
+				)
+				state["placeholder"] = await self.api_call(ctx.send(embed=embed))
+				embed = await work
+		except BaseException:
+			# Don't leave the DB work running, or its exception unretrieved, when bailing out early
+			work.cancel()
+			await asyncio.gather(work, return_exceptions=True)
+			raise
+
+		# Successful verifications are cleaned up after a while, failures stay up for the user to read.
+		delete_after = 30 if embed.color == Colour(0x00FF00) else None
+		await self.send_verify_status(ctx, embed, delete_after=delete_after)
+
+	async def verify_link(self, ctx: Context, one_time_password: str, verified_role: int, notes: List[str]) -> Embed:
+		"""
+		Does the DB side of a verification and returns the embed describing the outcome
+		"""
+		# Make sure their queued invalidations land before we look at, or write to, their links
+		await self.journal.flush(matching=lambda entry: (
+			entry["op"] == "invalidate_discord_id"
+			# Links aren't per guild, a leave queued in any guild would clobber this verification
+			and entry["discord_id"] == ctx.author.id
+		))
+
+		embed = Embed()
+		discord_link = await self.discord_link_for_discord_id(ctx.guild, ctx.author.id)
+
+		# Check if they might already be verified.
+		if discord_link and discord_link.valid:
+			# They are already verified, so let's just add any missing role(s).
 			if verified_role:
-				await ctx.author.add_roles(ctx.guild.get_role(verified_role), reason=f"Verified by Discord Link (ckey: `{discord_link.ckey}`)")
-
-			# Expensive, but let's just check if all went well.
-			discord_link = await self.discord_link_for_discord_id(ctx.guild, ctx.author.id)
-			# It did not, uh oh.
-			if not discord_link:
-				log.warning(f"The returned discord {ctx.author.id}.")
-				embed.title = "Could not verify!"
-				embed.description = "Something went wrong. Please contact staff before proceeding."
-				embed.set_footer(text="Error: Could not verify link after creation.")
-				embed.color = 0xFF0000
-				return await message.edit(embed=embed)
+				try:
+					await self.api_call(ctx.author.add_roles(ctx.guild.get_role(verified_role), reason=f"Reverified by Discord Link (ckey: `{discord_link.ckey}`)"))
+				except (DiscordException):
+					# Uh oh, we couldn't add the role.
+					log.exception(f"Failed to add role {verified_role} to {ctx.author.id}, {DiscordException}")
+					notes.append("I can't add the missing role(s) to you. Please contact staff.")
+
+			# Let them know of course
+			embed.title = "Success!"
+			embed.description = "You are already verified. If you were missing any roles, they have been added."
+			embed.color = 0x00FF00
+			return embed
+
+		# No OTP and no valid Discordlink. This won't do.
+		if one_time_password is None:
+			embed.title = "Could not verify!"
+			embed.description = f"""No OTP token given.
+									Please log into the server and get your OTP token.
+									Usage: {ctx.prefix}verify super-cool-token"""
+			embed.set_footer(text="Error: No token passed.")
+			embed.color = 0xFF0000
+			return embed
+
+		# They have supplied an OTP token, let's see if its valid
+		discord_link = await self.discord_link_for_token(ctx, one_time_password)
+		# It is not valid, or it doesn't exist.
+		if not discord_link:
+			embed.title = "Could not verify!"
+			embed.description = """
+				Invalid OTP token.
+				Please make sure you generated a token by joining the server first.
+				Else make sure you copied the token correctly. Do not add anything after the token.
+				The token should have the format of words between dashes.
+				e.g. `super-cool-token`"""
+			embed.set_footer(text="Error: Invalid or expired OTP token.")
+			embed.color = 0xFF0000
+			return embed
+
+		# It does exist and matched. Let's continue.
+		# Update their db entry with their discordid.
+		await self.update_discord_link(ctx, one_time_password, ctx.author.id)
+
+		# Give them roles too, if any.
+		if verified_role:
+			await self.api_call(ctx.author.add_roles(ctx.guild.get_role(verified_role), reason=f"Verified by Discord Link (ckey: `{discord_link.ckey}`)"))
+
+		# Expensive, but let's just check if all went well.
+		discord_link = await self.discord_link_for_discord_id(ctx.guild, ctx.author.id)
+		# It did not, uh oh.
+		if not discord_link:
+			log.warning(f"The returned discord {ctx.author.id}.")
+			embed.title = "Could not verify!"
+			embed.description = "Something went wrong. Please contact staff before proceeding."
+			embed.set_footer(text="Error: Could not verify link after creation.")
+			embed.color = 0xFF0000
+			return embed
 
 		# Let them know they've been verified.
 		embed.title = "Success!"
 		embed.description = "Verification complete!\nYou can now log in to the server."
 		embed.color = 0x00FF00
-		await message.edit(embed=embed, delete_after=30)
-		# Reset last message reference
-		self.last_message = None
-		return
+		return embed
+
+	async def send_verify_status(self, ctx: Context, embed: Embed, delete_after: float = None, stat: str = "api_calls"):
+		"""
+		Show the final status of a verification along with its notes, reusing the placeholder message if one was posted
+		"""
+		# Only dropped once sent, so the error handler can still deliver the notes if this fails
+		state = self.verify_states.get(ctx.message.id, {})
+		if state.get("notes"):
+			embed.add_field(name="Note", value="\n".join(state["notes"]), inline=False)
+
+		placeholder: Optional[Message] = state.pop("placeholder", None)
+		if placeholder:
+			try:
+				await self.api_call(placeholder.edit(embed=embed, delete_after=delete_after), stat=stat)
+			except (DiscordException):
+				# The placeholder might be gone, fall back to a new message.
+				placeholder = None
+		if not placeholder:
+			await self.api_call(ctx.send(embed=embed, delete_after=delete_after), stat=stat)
+		self.verify_states.pop(ctx.message.id, None)
+
+	async def api_call(self, coro: Awaitable, stat: str = "api_calls"):
+		"""
+		Await a Discord API call, counting it under `stat` in the verify call budget
+		"""
+		self.verify_stats[stat] += 1
+		return await coro
 
 	@verify.error
 	async def verify_error(self, ctx: Context, error):
-		# Delete the user's message if it exists.
-		# This could be caused by the deletion call in verify not being invoked before an exception is raised.
-		try:
-			await ctx.message.delete()
-		except (DiscordException):
-			pass
+		# Rejections never start a verification, so their calls are kept apart from the per verification budget.
+		rejected = isinstance(error, (commands.MaxConcurrencyReached, commands.CommandOnCooldown))
+		stat = "rejection_api_calls" if rejected else "api_calls"
+		if rejected:
+			self.verify_stats["rejections"] += 1
+
+		# Delete the user's message if verify never got to it.
+		# This could be caused by a check, like cooldown, failing before verify is invoked.
+		if ctx.message.id not in self.verify_states:
+			try:
+				await self.api_call(ctx.message.delete(), stat=stat)
+			except (DiscordException):
+				pass
 
 		embed = Embed(
 				description=f"```\n{format(error)}```",
@@ -213,12 +452,18 @@ class DiscordLinkCog(Cog):
 			log.exception(error)
 			embed.title = "Unexpected error occurred."
 			embed.description = f"Please try again. If this error persists, contact staff.\n```\n{format(error)}```"
-		await ctx.send(embed=embed, delete_after=30)
 
-		# Also delete the bot's waiting message, as an error occured and no further processing will be done.
-		if self.last_message:
-			await self.last_message.delete()
-			self.last_message = None
+		# Turns the bot's waiting message, if any, into the error, as no further processing will be done.
+		try:
+			await self.send_verify_status(ctx, embed, delete_after=30, stat=stat)
+		finally:
+			# Nothing will retry after this, don't keep the state around if sending failed
+			self.verify_states.pop(ctx.message.id, None)
+
+	@commands.Cog.listener()
+	async def on_deebee_reconnect(self, guild: Guild):
+		# Database is back, don't wait out the backoff
+		self.journal.wake()
 
 	@commands.Cog.listener()
 	async def on_member_join(self, member: Member):
@@ -258,7 +503,7 @@ class DiscordLinkCog(Cog):
 		if not members_only:
 			return
 
-		await self.clear_all_valid_discord_links_for_discord_id(guild, member.id)
+		await self.queue_clear_all_valid_discord_links_for_discord_id(guild, member.id)
 
 	async def update_discord_link(self, ctx: Context, one_time_token: str, user_discord_snowflake: str) -> bool:
 		"""
@@ -283,17 +528,21 @@ class DiscordLinkCog(Cog):
 		#	AND :discord_id IS NULL
 		#""").bindparams(tablename=DiscordLink, discord_id=user_discord_snowflake, one_time_token=one_time_token)
 
-		stmt = update(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.update(
 			DiscordLink
 		).where(
-			DiscordLink.one_time_token == one_time_token,
+			await self.token_clause(ctx.guild, one_time_token),
 			DiscordLink.timestamp >= datetime.now(timezone.utc) - timedelta(hours=4)
 		).values(
 			discord_id = user_discord_snowflake,
 			valid = True
 		)
 
-		await self.db.query(ctx, stmt, commit=True)
+		db = await self.get_database()
+		await db.query(ctx, stmt, commit=True)
+		self.invalidate_link_cache()
 
 	async def discord_link_for_token(self, ctx: Context, one_time_token: str) -> DiscordLink or None:
 		"""
@@ -311,19 +560,32 @@ class DiscordLinkCog(Cog):
 		#	LIMIT 1
 		#""").bindparams(tablename=DiscordLink, one_time_token=one_time_token)
 
-		stmt = select(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.select(
 			DiscordLink
 		).where(
-			DiscordLink.one_time_token == one_time_token,
+			await self.token_clause(ctx.guild, one_time_token),
 			DiscordLink.timestamp >= datetime.now(timezone.utc) - timedelta(hours=4)
 		).order_by(
 			DiscordLink.timestamp.desc()
 		).limit(1)
 
-		result: Row = await self.db.query_single(ctx, stmt)
+		db = await self.get_database()
+		result: Row = await db.query_single(ctx, stmt)
 		log.debug(f"discord_link_for_token: {result}")
 		return result
 
+	async def token_clause(self, guild: Guild, one_time_token: str):
+		"""
+		Returns the clause matching a one time token, by its digest if enabled for the guild
+		"""
+		DiscordLink, _ = _orm()
+
+		if await self.config.guild(guild).token_hash():
+			return DiscordLink.one_time_token_hash == DiscordLink.token_digest(one_time_token)
+		return DiscordLink.one_time_token == one_time_token
+
 	async def discord_link_for_discord_id(self, guild: Guild, discord_id: str) -> DiscordLink or None:
 		"""
 		Given a valid discord id, return the latest record linked to that user
@@ -337,7 +599,9 @@ class DiscordLinkCog(Cog):
 		#	ORDER BY timestamp DESC
 		#	LIMIT 1
 		#""").bindparams(tablename=DiscordLink, discord_id=discord_id)
-		stmt = select(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.select(
 			DiscordLink
 		).where(
 			DiscordLink.discord_id == discord_id
@@ -345,7 +609,8 @@ class DiscordLinkCog(Cog):
 			DiscordLink.timestamp.desc()
 		).limit(1)
 
-		result: Row = await self.db.query_single(guild, stmt)
+		db = await self.get_database()
+		result: Row = await db.query_single(guild, stmt)
 		log.debug(f"discord_link_for_discord_id: {result}")
 		return result
 
@@ -363,7 +628,9 @@ class DiscordLinkCog(Cog):
 		#	LIMIT 1
 		#""").bindparams(tablename=tablename, ckey=ckey)
 
-		stmt = select(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.select(
 			DiscordLink
 		).where(
 			DiscordLink.ckey == ckey,
@@ -372,7 +639,8 @@ class DiscordLinkCog(Cog):
 			DiscordLink.timestamp.desc()
 		).limit(1)
 
-		result: Row = await self.db.query_single(ctx, stmt)
+		db = await self.get_database()
+		result: Row = await db.query_single(ctx, stmt)
 		log.debug(f"discord_link_for_ckey: {result}")
 		return result
 
@@ -393,7 +661,9 @@ class DiscordLinkCog(Cog):
 		#	AND valid = TRUE
 		#""").bindparams(tablename=tablename, ckey=ckey)
 
-		stmt = update(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.update(
 			DiscordLink
 		).where(
 			DiscordLink.ckey == ckey,
@@ -402,7 +672,9 @@ class DiscordLinkCog(Cog):
 			valid = False
 		)
 
-		await self.db.query(ctx, stmt, commit=True)
+		db = await self.get_database()
+		await db.query(ctx, stmt, commit=True)
+		self.invalidate_link_cache()
 
 	async def clear_all_valid_discord_links_for_discord_id(self, guild: Guild, discord_id: int):
 		"""
@@ -421,7 +693,9 @@ class DiscordLinkCog(Cog):
 		#	AND valid = TRUE
 		#""").bindparams(tablename=tablename, discord_id=discord_id)
 
-		stmt = update(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.update(
 			DiscordLink
 		).where(
 			DiscordLink.discord_id == discord_id,
@@ -430,7 +704,71 @@ class DiscordLinkCog(Cog):
 			valid = False
 		)
 
-		await self.db.query(guild, stmt, commit=True)
+		db = await self.get_database()
+		await db.query(guild, stmt, commit=True)
+		self.invalidate_link_cache()
+
+	async def queue_clear_all_valid_discord_links_for_discord_id(self, guild: Guild, discord_id: int):
+		"""
+		Journal the invalidation of all links for the given discord id, to be applied in the background
+
+		Parameters
+		----------
+		discord_id: int
+			The discord id to invalidate the links for
+		"""
+		await self.journal.append("invalidate_discord_id", guild_id=guild.id, discord_id=discord_id)
+
+	async def apply_journal_entries(self, entries: List[dict]) -> List[dict]:
+		"""
+		Apply a batch of journaled writes, one statement per guild and operation
+
+		Returns the entries that can't be applied yet, because no guild is available to resolve the database through
+		"""
+		DiscordLink, sa = _orm()
+
+		kept: List[dict] = []
+		invalidations: Dict[Guild, List[dict]] = {}
+		for entry in entries:
+			if entry["op"] != "invalidate_discord_id":
+				log.error(f"Dropping journal entry with unknown operation: {entry}")
+				continue
+
+			guild = self.guild_for_journal_entry(entry)
+			if not guild:
+				kept.append(entry)
+				continue
+			invalidations.setdefault(guild, []).append(entry)
+
+		for guild, guild_entries in invalidations.items():
+			discord_ids = {entry["discord_id"] for entry in guild_entries}
+
+			stmt = sa.update(
+				DiscordLink
+			).where(
+				DiscordLink.discord_id.in_(discord_ids),
+				DiscordLink.valid == True
+			).values(
+				valid = False
+			)
+
+			db = await self.get_database()
+			await db.query(guild, stmt, commit=True)
+			self.invalidate_link_cache()
+
+		return kept
+
+	def guild_for_journal_entry(self, entry: dict) -> Optional[Guild]:
+		"""
+		Returns the guild to resolve the database through for a journal entry
+
+		The guild only selects DeeBee's configuration, links aren't per guild,
+		so any available guild will do if the bot has since left the journaled one.
+		"""
+		guild = self.bot.get_guild(entry["guild_id"])
+		if guild and not guild.unavailable:
+			return guild
+		return next((guild for guild in self.bot.guilds if not guild.unavailable), None)
 
 	async def all_discord_links_for_ckey(self, ctx: Context, ckey: str) -> List[DiscordLink]:
 		"""
@@ -445,7 +783,9 @@ class DiscordLinkCog(Cog):
 		#	ORDER BY timestamp DESC
 		#""").bindparams(tablename=tablename, ckey=ckey)
 
-		stmt = select(
+		DiscordLink, sa = _orm()
+
+		stmt = sa.select(
 			DiscordLink
 		).where(
 			DiscordLink.ckey == ckey,
@@ -454,12 +794,96 @@ class DiscordLinkCog(Cog):
 			DiscordLink.timestamp.desc()
 		)
 
-		result: List[Row] = await self.db.query(ctx, stmt)
+		db = await self.get_database()
+		result: List[Row] = await db.query(ctx, stmt)
 		log.debug(f"all_discord_links_for_ckey: {result}")
 		return result
 
-	def get_database(self) -> Cog:
+	async def discord_links_for_discord_ids(self, guild: Guild, discord_ids: Iterable[int or str]) -> Dict[int, Optional[DiscordLink]]:
+		"""
+		Given discord ids, return a mapping of each to its latest link record, or None if it has none
+
+		Meant for other cogs needing the link status of many users at once.
+		Ids may be given as strings, the returned mapping is keyed by their int value.
+		Lookups are batched, shared with concurrent callers and briefly cached, so treat the records as read-only.
+		"""
+		# The DB column is a BIGINT, string keys would never match the fetched records
+		return await self.links_by_discord_id.load_many(guild, [int(discord_id) for discord_id in discord_ids])
+
+	async def discord_links_for_ckeys(self, guild: Guild, ckeys: Iterable[str]) -> Dict[str, Optional[DiscordLink]]:
+		"""
+		Given ckeys, return a mapping of each to its latest record linked to a discord id, or None if it has none
+
+		Meant for other cogs needing the link status of many users at once.
+		Lookups are batched, shared with concurrent callers and briefly cached, so treat the records as read-only.
+		"""
+		return await self.links_by_ckey.load_many(guild, ckeys)
+
+	def invalidate_link_cache(self):
+		"""
+		Drop cached link records, call after writing to the links table
+		"""
+		self.links_by_discord_id.invalidate()
+		self.links_by_ckey.invalidate()
+
+	async def _fetch_links_for_discord_ids(self, guild: Guild, discord_ids: List[int]) -> Dict[int, DiscordLink]:
+		DiscordLink, sa = _orm()
+
+		stmt = sa.select(
+			DiscordLink
+		).where(
+			DiscordLink.discord_id.in_(discord_ids)
+		).order_by(
+			DiscordLink.timestamp.desc()
+		)
+
+		db = await self.get_database()
+		result: List[Row] = await db.query(guild, stmt)
+		links: Dict[int, DiscordLink] = {}
+		# Newest first, so the first record seen per discord id is the latest
+		for link in result:
+			links.setdefault(link.discord_id, link)
+		log.debug(f"_fetch_links_for_discord_ids: {len(links)} of {len(discord_ids)} linked")
+		return links
+
+	async def _fetch_links_for_ckeys(self, guild: Guild, ckeys: List[str]) -> Dict[str, DiscordLink]:
+		DiscordLink, sa = _orm()
+
+		stmt = sa.select(
+			DiscordLink
+		).where(
+			DiscordLink.ckey.in_(ckeys),
+			DiscordLink.discord_id != None
+		).order_by(
+			DiscordLink.timestamp.desc()
+		)
+
+		db = await self.get_database()
+		result: List[Row] = await db.query(guild, stmt)
+		links: Dict[str, DiscordLink] = {}
+		# Newest first, so the first record seen per ckey is the latest
+		for link in result:
+			links.setdefault(link.ckey, link)
+		log.debug(f"_fetch_links_for_ckeys: {len(links)} of {len(ckeys)} linked")
+		return links
+
+	@commands.Cog.listener()
+	async def on_cog_add(self, cog: Cog):
+		if cog.qualified_name == "DeeBee":
+			self._db_ready.set()
+
+	async def get_database(self, timeout: float = 30) -> Cog:
+		"""
+		Returns the DeeBee cog, waiting up to `timeout` seconds for it to be loaded
+		"""
 		db = self.bot.get_cog("DeeBee")
+		if not db:
+			try:
+				await asyncio.wait_for(self._db_ready.wait(), timeout)
+			except asyncio.TimeoutError:
+				raise ModuleNotFoundError("Database cog not found.")
+			db = self.bot.get_cog("DeeBee")
+
 		if not db:
 			raise ModuleNotFoundError("Database cog not found.")
 		return db
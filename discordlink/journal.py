@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+log = logging.getLogger("red.horizon.cogs.discordlink.journal")
+
+class LinkJournal:
+	"""
+	Durable write-behind journal for non-critical link writes.
+
+	Entries are appended to a local JSON lines file and fsynced before `append` returns.
+	A background flusher hands them to `apply` in batches and only drops them from disk once applied,
+	so anything still pending on shutdown or DB outage is replayed on the next start or reconnect.
+	`apply` returns the entries of the batch it could not apply yet, those are kept for a later flush.
+	The flusher waits for `ready`, if given, before applying anything.
+	"""
+	def __init__(
+		self,
+		path: Path,
+		apply: Callable[[List[dict]], Awaitable[Iterable[dict]]],
+		ready: Callable[[], Awaitable[None]] = None,
+		batch_size: int = 100,
+		coalesce_delay: float = 1.0,
+		flush_interval: float = 30.0,
+		max_backoff: float = 300.0,
+	):
+		self.path = Path(path)
+		self.apply = apply
+		self.ready = ready
+		self.batch_size = batch_size
+		self.coalesce_delay = coalesce_delay
+		self.flush_interval = flush_interval
+		self.max_backoff = max_backoff
+
+		self.pending: List[dict] = []
+		self._seq = 0
+		self._file_lock = asyncio.Lock()
+		self._flush_lock = asyncio.Lock()
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+
+	def start(self):
+		"""
+		Replay whatever is left on disk and start the background flusher
+		"""
+		if self._task:
+			return
+		self.pending = self._load()
+		self._seq = max((entry["seq"] for entry in self.pending), default=0)
+		if self.pending:
+			log.info(f"Replaying {len(self.pending)} journaled link write(s)")
+		self._task = asyncio.get_event_loop().create_task(self._run())
+
+	def stop(self):
+		"""
+		Stop the background flusher. Pending entries stay on disk for the next start.
+		"""
+		if self._task:
+			self._task.cancel()
+			self._task = None
+
+	def wake(self):
+		"""
+		Ask the flusher to retry right away, e.g. after the database came back
+		"""
+		self._wakeup.set()
+
+	async def append(self, op: str, **data):
+		"""
+		Durably record a write to be applied later
+		"""
+		self._seq += 1
+		entry = {"seq": self._seq, "op": op, **data}
+		async with self._file_lock:
+			await self._in_executor(self._write_line, json.dumps(entry))
+		self.pending.append(entry)
+		self._wakeup.set()
+
+	async def flush(self, matching: Callable[[dict], bool] = None):
+		"""
+		Apply the currently pending entries, or only those `matching` if given, raising if the database rejects them.
+
+		Used with `matching` as a barrier by code that has to read its own queued writes.
+		Returns the number of entries `apply` kept for later.
+		"""
+		kept_count = 0
+		async with self._flush_lock:
+			todo = [entry for entry in self.pending if not matching or matching(entry)]
+			for i in range(0, len(todo), self.batch_size):
+				batch = todo[i:i + self.batch_size]
+				kept = {entry["seq"] for entry in await self.apply(batch)}
+				kept_count += len(kept)
+				applied = {entry["seq"] for entry in batch} - kept
+				if not applied:
+					continue
+				self.pending = [entry for entry in self.pending if entry["seq"] not in applied]
+				async with self._file_lock:
+					await self._in_executor(self._rewrite, list(self.pending))
+		return kept_count
+
+	async def _run(self):
+		if self.ready:
+			await self.ready()
+
+		backoff = self.coalesce_delay
+		while True:
+			if self.pending:
+				# Give concurrent events a moment to land in the same batch
+				await asyncio.sleep(self.coalesce_delay)
+				try:
+					kept_count = await self.flush()
+				except asyncio.CancelledError:
+					raise
+				except Exception:
+					log.warning(f"Failed to apply {len(self.pending)} journaled link write(s), retrying in {backoff}s", exc_info=True)
+					kept_count = None
+
+				if kept_count is None or kept_count:
+					if kept_count:
+						log.debug(f"Holding back {kept_count} journaled link write(s), retrying in {backoff}s")
+					await self._wait(backoff)
+					backoff = min(backoff * 2, self.max_backoff)
+					continue
+				backoff = self.coalesce_delay
+			await self._wait(self.flush_interval)
+
+	async def _wait(self, timeout: float):
+		try:
+			await asyncio.wait_for(self._wakeup.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		self._wakeup.clear()
+
+	async def _in_executor(self, func, *args):
+		return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+	def _load(self) -> List[dict]:
+		entries = []
+		if not self.path.exists():
+			return entries
+		with self.path.open("r", encoding="utf-8") as fp:
+			for line in fp:
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					entries.append(json.loads(line))
+				except ValueError:
+					# Torn write from a crash mid-append, it was never acknowledged
+					log.warning(f"Skipping corrupt journal line: {line!r}")
+		return entries
+
+	def _write_line(self, line: str):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		with self.path.open("a", encoding="utf-8") as fp:
+			fp.write(line + "\n")
+			fp.flush()
+			os.fsync(fp.fileno())
+
+	def _rewrite(self, entries: List[dict]):
+		tmp_path = self.path.with_suffix(".tmp")
+		with tmp_path.open("w", encoding="utf-8") as fp:
+			for entry in entries:
+				fp.write(json.dumps(entry) + "\n")
+			fp.flush()
+			os.fsync(fp.fileno())
+		os.replace(tmp_path, self.path)
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from discord import Guild
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Set, Tuple
+
+class LinkLoader:
+	"""
+	Batched, deduplicated and cached lookup of link records by a single key, e.g. discord id or ckey.
+
+	Keys already being fetched by another caller are awaited instead of fetched again (single-flight),
+	the rest are fetched through `fetch` in chunks of `chunk_size` and cached for `ttl` seconds, misses included.
+	"""
+	def __init__(
+		self,
+		fetch: Callable[[Guild, List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+		chunk_size: int = 500,
+		ttl: float = 60.0,
+		max_size: int = 10000,
+	):
+		self.fetch = fetch
+		self.chunk_size = chunk_size
+		self.ttl = ttl
+		self.max_size = max_size
+
+		self.cache: Dict[Tuple[int, Hashable], Tuple[float, Any]] = {}
+		self.in_flight: Dict[Tuple[int, Hashable], asyncio.Future] = {}
+		# Fetches run as their own tasks, so they don't depend on the caller that started them
+		self.fetches: Set[asyncio.Task] = set()
+		# Bumped on invalidation, so fetches started before it don't cache stale records
+		self.generation = 0
+
+	def invalidate(self):
+		"""
+		Drop everything cached, call after writing to the links table
+
+		Fetches already running finish for their callers, but later callers don't join them.
+		"""
+		self.cache.clear()
+		self.in_flight.clear()
+		self.generation += 1
+
+	async def load_many(self, guild: Guild, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+		"""
+		Returns a mapping of every given key to its record, or None if there is none
+		"""
+		now = time.monotonic()
+		results: Dict[Hashable, Any] = {}
+		waiting: Dict[Hashable, asyncio.Future] = {}
+		missing: List[Hashable] = []
+
+		for key in set(keys):
+			cached = self.cache.get((guild.id, key))
+			if cached and cached[0] > now:
+				results[key] = cached[1]
+			elif (guild.id, key) in self.in_flight:
+				waiting[key] = self.in_flight[(guild.id, key)]
+			else:
+				missing.append(key)
+
+		if missing:
+			loop = asyncio.get_event_loop()
+			futures = {key: loop.create_future() for key in missing}
+			for key, future in futures.items():
+				self.in_flight[(guild.id, key)] = future
+			waiting.update(futures)
+			fetch = asyncio.ensure_future(self._fetch_into(guild, missing, futures))
+			self.fetches.add(fetch)
+			fetch.add_done_callback(self.fetches.discard)
+
+		if waiting:
+			# Shielded, so a cancelled caller doesn't cancel the fetch for everyone else awaiting it
+			values = await asyncio.gather(*(asyncio.shield(future) for future in waiting.values()))
+			results.update(zip(waiting.keys(), values))
+		return results
+
+	async def _fetch_into(self, guild: Guild, keys: List[Hashable], futures: Dict[Hashable, asyncio.Future]):
+		generation = self.generation
+		try:
+			for i in range(0, len(keys), self.chunk_size):
+				chunk = keys[i:i + self.chunk_size]
+				fetched = await self.fetch(guild, chunk)
+				expires = time.monotonic() + self.ttl
+				for key in chunk:
+					value = fetched.get(key)
+					if generation == self.generation:
+						self._store((guild.id, key), expires, value)
+					futures[key].set_result(value)
+		except Exception as error:
+			# Raised to every caller waiting on these keys
+			for future in futures.values():
+				if not future.done():
+					future.set_exception(error)
+					# Mark it retrieved, there may be no caller left to await it and it would be logged per key
+					future.exception()
+		except BaseException:
+			for future in futures.values():
+				future.cancel()
+			raise
+		finally:
+			for key, future in futures.items():
+				# Might have been replaced by a fetch started after an invalidation
+				if self.in_flight.get((guild.id, key)) is future:
+					del self.in_flight[(guild.id, key)]
+
+	def _store(self, cache_key: Tuple[int, Hashable], expires: float, value: Any):
+		if len(self.cache) >= self.max_size:
+			now = time.monotonic()
+			self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+			if len(self.cache) >= self.max_size:
+				self.cache.clear()
+		self.cache[cache_key] = (expires, value)
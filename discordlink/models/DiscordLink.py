@@ -1,14 +1,32 @@
-from sqlalchemy import BIGINT, BOOLEAN, INTEGER, TIMESTAMP, VARCHAR, BigInteger, Column, Integer
-from sqlalchemy.orm import declarative_base
+import hashlib
+
+from sqlalchemy import BIGINT, BINARY, BOOLEAN, INTEGER, TIMESTAMP, VARCHAR, BigInteger, Column, Index, Integer
+from sqlalchemy.orm import declarative_base, deferred
 
 Base = declarative_base()
 
 class DiscordLink(Base):
 	__tablename__ = 'discord_links'
+	__table_args__ = (
+		Index('idx_discord_links_token_hash', 'one_time_token_hash', 'timestamp'),
+	)
 
 	id = Column(INTEGER, primary_key=True)
 	ckey = Column(VARCHAR(32))
 	discord_id = Column(BIGINT)
 	timestamp = Column(TIMESTAMP)
 	one_time_token = Column(VARCHAR(100))
+	# Optional SHA-256 digest of one_time_token, only used when enabled in the guild's preferences.
+	# Deferred so tables without this column can still be queried.
+	one_time_token_hash = deferred(Column(BINARY(32)))
 	valid = Column(BOOLEAN)
+
+	@staticmethod
+	def token_digest(one_time_token: str) -> bytes:
+		"""
+		Returns the value stored in one_time_token_hash for the given one time token
+
+		Hashes the stripped, lowercased token, so matching stays as lenient as the
+		case- and trailing-space-insensitive VARCHAR comparison it replaces.
+		"""
+		return hashlib.sha256(one_time_token.strip().lower().encode("utf-8")).digest()